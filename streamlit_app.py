@@ -1,12 +1,20 @@
-import io, os
+import bisect, functools, hashlib, itertools, os, queue, re, sys, threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple
 
 import cv2
 import fitz  # PyMuPDF
 import numpy as np
 import pytesseract
+from pytesseract import Output
 import streamlit as st
 
+try:  # in-process tesseract; without it every page spawns the tesseract CLI
+    import tesserocr
+    from PIL import Image
+except ImportError:
+    tesserocr = None
+
 st.set_page_config(page_title="Music Staff Extractor – OCR", page_icon="🎼")
 
 # ------------------------- UI ------------------------- #
@@ -14,103 +22,410 @@ st.title("🎼 Music Staff Extractor – vision + OCR")
 
 st.markdown(
     "Upload a choral score PDF, type staff labels (one per line).  The app "
-    "detects each system visually, OCRs the label at the left, and keeps only "
-    "systems whose label text matches one you entered."
+    "reads the label at the left of each system – from the PDF's text where it "
+    "has labels there, otherwise by detecting systems visually and OCRing the "
+    "label – and keeps only systems whose label text matches one you entered."
 )
 
 pdf_file = st.file_uploader("PDF score", type=["pdf"])
-labels_raw = st.text_area("Target staff labels – one per line", "Bass I\nBass II", height=120)
-labels_set = {l.strip().lower() for l in labels_raw.splitlines() if l.strip()}
 
-extra_pad = st.slider("Extra vertical padding around staff (px)", 0, 80, 20, 2)
-run_btn = st.button("🚀 Extract")
+# a form, so editing labels or dragging the slider doesn't rerun the script
+# until Extract is pressed
+MODES = {"Auto": "auto", "Text layer only": "text", "OCR only": "ocr"}
+with st.form("extract_form"):
+    labels_raw = st.text_area("Target staff labels – one per line", "Bass I\nBass II", height=120)
+    extra_pad = st.slider("Extra vertical padding around staff (px)", 0, 80, 20, 2)
+    mode = MODES[st.radio("Read labels from", list(MODES), horizontal=True)]
+    raster = st.radio("Output", ["Vector", "Raster (faster, flat grayscale images)"], horizontal=True) != "Vector"
+    run_btn = st.form_submit_button("🚀 Extract")
+labels_set = {l.strip().lower() for l in labels_raw.splitlines() if l.strip()}
 
 # -------------------- Vision helpers -------------------- #
 
-def page_to_img(page, zoom=2.0) -> np.ndarray:
+@st.cache_resource
+def mupdf_lock() -> threading.Lock:
+    return threading.Lock()
+
+
+# PyMuPDF is not thread-safe: every call into MuPDF goes through this lock, which
+# is shared by all sessions, while OpenCV and tesseract work runs concurrently.
+_MUPDF_LOCK = mupdf_lock()
+# damaged scores make MuPDF print a line to stderr for every object it repairs;
+# they are still collected in fitz.TOOLS.mupdf_warnings()
+fitz.TOOLS.mupdf_display_errors(False)
+
+DETECT_ZOOM = 1.0  # 72 dpi is plenty for finding staff lines
+OCR_ZOOM = 3.0  # tesseract wants high resolution on short labels
+LABEL_COL_PT = 110  # width of the left-margin label column, in PDF points
+
+
+def page_to_gray(page, zoom=DETECT_ZOOM, clip=None) -> np.ndarray:
     mat = fitz.Matrix(zoom, zoom)
-    pix = page.get_pixmap(matrix=mat, alpha=False)
-    img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, 3)
-    return cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-
-
-def detect_systems(img: np.ndarray) -> List[Tuple[int, int, int, int]]:
-    """Return (x,y,w,h) boxes for horizontal staff systems."""
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    # emphasise horizontal lines
-    sobel = cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=3)
-    sobel = cv2.convertScaleAbs(sobel)
-    _, th = cv2.threshold(sobel, 0, 255, cv2.THRESH_OTSU | cv2.THRESH_BINARY)
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (gray.shape[1] // 4, 5))
-    dil = cv2.dilate(th, kernel, iterations=2)
-
-    contours, _ = cv2.findContours(dil, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    boxes = []
+    pix = page.get_pixmap(matrix=mat, colorspace=fitz.csGRAY, clip=clip, alpha=False)
+    return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width)
+
+
+def detect_systems(gray: np.ndarray, zoom: float = DETECT_ZOOM) -> List[Tuple[int, int, int, int]]:
+    """Return (x,y,w,h) boxes for horizontal staff systems in a page rendered at `zoom`.
+
+    Rows with ink across at least 30% of the page width are staff lines; lines
+    less than `line_gap` px apart belong to the same system.
+    """
     h_img, w_img = gray.shape
-    for c in contours:
-        x, y, w, h = cv2.boundingRect(c)
-        if w > 0.65 * w_img and 40 < h < 260:
-            boxes.append((x, y, w, h))
-    boxes.sort(key=lambda b: b[1])
-    return boxes
+    line_gap = 10 * zoom
+    _, bw = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    row_ink = cv2.reduce(bw, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel()
+
+    mask = (row_ink > 0.3 * w_img).astype(np.int8)
+    edges = np.flatnonzero(np.diff(np.r_[0, mask, 0]))
+    starts, ends = edges[::2], edges[1::2]
+    if not len(starts):
+        return []
+    split = starts[1:] - ends[:-1] > line_gap
+    starts, ends = starts[np.r_[True, split]], ends[np.r_[split, True]]
+    return [(0, int(y0), w_img, int(y1 - y0)) for y0, y1 in zip(starts, ends) if 15 * zoom < y1 - y0 < 125 * zoom]
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def detect_systems_cached(pdf_key: str, pno: int, zoom: float, _src) -> List[Tuple[int, int, int, int]]:
+    """detect_systems() for page `pno` of `_src`; the page is only rendered on a cache miss."""
+    with _MUPDF_LOCK:
+        gray = page_to_gray(_src.load_page(pno), zoom=zoom)
+    return detect_systems(gray, zoom)
 
 
 def clean_text(txt: str) -> str:
     return " ".join(txt.strip().replace("\n", " ").split()).lower()
 
 
-def ocr_strip(img: np.ndarray) -> str:
-    if img.size == 0:
-        return ""
-    cfg = "--psm 7 --oem 3"
-    txt = pytesseract.image_to_string(img, config=cfg)
-    return clean_text(txt)
+@st.cache_resource
+def tess_pool() -> queue.SimpleQueue:
+    """Idle tesserocr handles, kept across reruns so each loads its model only once."""
+    return queue.SimpleQueue()
+
+
+def ocr_strips(strips: List[np.ndarray], gap: int = 30) -> List[str]:
+    """OCR all (grayscale) label strips of a page; one text per strip.
+
+    Strips with (almost) no dark pixels have no label and are not sent to tesseract.
+    """
+    texts = [""] * len(strips)
+    inked = [i for i, s in enumerate(strips) if s.size and (s < 128).mean() >= 0.001]
+    if not inked:
+        return texts
+    todo = [strips[i] for i in inked]
+    found = ocr_strips_api(todo) if tesserocr is not None else ocr_strips_cli(todo, gap)
+    for i, txt in zip(inked, found):
+        texts[i] = txt
+    return texts
+
+
+def ocr_strips_api(strips: List[np.ndarray]) -> List[str]:
+    """OCR each strip as a single line through a persistent tesserocr handle."""
+    pool = tess_pool()
+    try:
+        api = pool.get_nowait()
+    except queue.Empty:
+        api = tesserocr.PyTessBaseAPI(psm=tesserocr.PSM.SINGLE_LINE, oem=tesserocr.OEM.DEFAULT)
+    try:
+        texts = []
+        for strip in strips:
+            api.SetImage(Image.fromarray(strip))
+            texts.append(clean_text(api.GetUTF8Text()))
+        return texts
+    finally:
+        pool.put(api)
+
+
+def ocr_strips_cli(strips: List[np.ndarray], gap: int = 30) -> List[str]:
+    """OCR all (non-empty) strips with one pytesseract call.
+
+    The strips are stacked vertically with white gaps in between and each
+    recognised word is assigned back to the strip its vertical centre falls in.
+    """
+    width = max(s.shape[1] for s in strips)
+    parts, starts, y = [], [], 0
+    for strip in strips:
+        h, w = strip.shape[:2]
+        part = np.full((h + gap, width), 255, dtype=np.uint8)
+        part[:h, :w] = strip
+        parts.append(part)
+        starts.append(y)
+        y += h + gap
+
+    cfg = "--psm 6 --oem 3"
+    data = pytesseract.image_to_data(np.vstack(parts), config=cfg, output_type=Output.DICT)
+    words = [[] for _ in strips]
+    for txt, top, height in zip(data["text"], data["top"], data["height"]):
+        if txt.strip():
+            words[bisect.bisect_right(starts, top + height // 2) - 1].append(txt)
+    return [clean_text(" ".join(ws)) for ws in words]
+
+
+# -------------------- Text-layer helpers -------------------- #
+
+_DROP_PUNCT = str.maketrans("", "", "".join(chr(c) for c in range(128) if not chr(c).isalnum()))
+_HAS_ALPHA = re.compile("[A-Za-z]").search
+_IS_CREDIT = re.compile(r"Words and Music by|Arr\.|From ").search  # credit lines, not staff labels
+
+
+@functools.lru_cache(maxsize=1024)
+def norm_label(txt: str) -> str:
+    return txt.translate(_DROP_PUNCT).lower()
+
+
+@functools.lru_cache(maxsize=32)
+def targets_pattern(norm_targets: frozenset) -> re.Pattern:
+    """One alternation over all normalised targets, longest first, to scan page text in a single pass."""
+    return re.compile("|".join(re.escape(t) for t in sorted(norm_targets, key=len, reverse=True)))
+
+
+def text_lines(page, textpage=None) -> List[Tuple[float, float, str]]:
+    """Return (y0, y1, text) for every text line starting in the label column."""
+    lines = []
+    words = page.get_text("words", textpage=textpage)  # (x0, y0, x1, y1, word, block, line, word_no)
+    for _, line in itertools.groupby(words, key=lambda w: (w[5], w[6])):
+        line = list(line)
+        # most lines on a page are music or lyrics: reject them before joining text
+        if line[0][0] >= LABEL_COL_PT:
+            continue
+        lines.append((min(w[1] for w in line), max(w[3] for w in line), " ".join(w[4] for w in line)))
+    return lines
+
+
+def text_systems(lines: List[Tuple[float, float, str]], page_h: float) -> List[Tuple[float, float, str]]:
+    """Return (top, bottom, label) for each label in the left margin, top to bottom.
+
+    A label sits level with its staff, so each system is taken to reach halfway
+    to the labels above and below it.
+    """
+    labels = []
+    for y0, y1, txt in sorted(line for line in lines if _HAS_ALPHA(line[2]) and not _IS_CREDIT(line[2])):
+        # the same text drawn over itself (fake bold, overprinting) is one label
+        if labels and labels[-1][2] == txt and y0 < labels[-1][1]:
+            continue
+        labels.append((y0, y1, txt))
+    mids = [(y0 + y1) / 2 for y0, y1, _ in labels]
+    systems = []
+    for i, (y0, y1, txt) in enumerate(labels):
+        above = (mids[i] - mids[i - 1]) / 2 if i > 0 else None
+        below = (mids[i + 1] - mids[i]) / 2 if i + 1 < len(mids) else None
+        half = above or below or 4 * (y1 - y0)
+        top = mids[i] - (above or half)
+        bottom = mids[i] + (below or half)
+        systems.append((max(0, top), min(page_h, bottom), txt))
+    return systems
 
 
 # -------------------- Extraction core -------------------- #
 
-def extract_staffs(pdf_bytes: bytes, targets: set[str], pad: int) -> Tuple[bytes, List[str]]:
-    src = fitz.open(stream=pdf_bytes, filetype="pdf")
-    dst = fitz.open()
-    a4w, a4h = fitz.paper_size("a4")
+A4_W, A4_H = fitz.paper_size("a4")
+RASTER_ZOOM = 200 / 72  # raster output is rendered at 200 dpi
+
+
+@st.cache_data(max_entries=4096, show_spinner=False)
+def page_text_layer(pdf_key: str, pno: int, _src) -> Tuple[str, List[Tuple[float, float, str]], float, bool]:
+    """Plain text, label-column lines, height and whether page `pno` has images.
+
+    The text comes from a single TextPage.
+
+    Cached on (pdf_key, pno): the text layer does not depend on the targets, so
+    reruns with other labels need no MuPDF work at all for text pages.
+    """
+    with _MUPDF_LOCK:
+        page = _src.load_page(pno)
+        tp = page.get_textpage()
+        layer = tp.extractText(), text_lines(page, tp), page.rect.height, bool(page.get_images())
+        del tp, page  # finalise them while still holding the lock
+    return layer
 
-    found_labels = []
-    y_cursor, dst_page = 20, None
-    gap = 10
 
-    for pno in range(src.page_count):
+def locate_text(
+    page_text: str, lines: List[Tuple[float, float, str]], page_h: float, norm_targets: frozenset
+) -> List[Tuple[float, float, str]]:
+    """Target systems on a born-digital page, from labels in its text layer.
+
+    `norm_targets` are the targets already passed through norm_label().
+    """
+    # one scan of the page's plain text, normalised like the labels, rules out
+    # pages without any target before their labels are laid out
+    flat = page_text.translate(_DROP_PUNCT).lower()
+    if not targets_pattern(norm_targets).search(flat):
+        return []
+    return [
+        (top, bottom, clean_text(txt))
+        for top, bottom, txt in text_systems(lines, page_h)
+        if norm_label(txt) in norm_targets
+    ]
+
+
+def locate_ocr(src, pdf_key: str, pno: int, targets: set[str]) -> List[Tuple[float, float, str]]:
+    """Target systems on a page found visually, with their labels read by OCR."""
+    systems = detect_systems_cached(pdf_key, pno, DETECT_ZOOM, src)
+    bands = [(y / DETECT_ZOOM, (y + h) / DETECT_ZOOM) for (x, y, w, h) in systems]
+    # OCR a sharp render of just the label column instead of a crop of the detection raster
+    with _MUPDF_LOCK:
         page = src.load_page(pno)
-        img = page_to_img(page, zoom=2.0)
-        systems = detect_systems(img)
-        scale = 0.5  # because zoom=2
-
-        for (x, y, w, h) in systems:
-            strip = img[y : y + h, 0 : min(220, w)]
-            label_txt = ocr_strip(strip)
-            if label_txt in targets:
-                found_labels.append(label_txt)
+        strips = [page_to_gray(page, OCR_ZOOM, fitz.Rect(0, top, LABEL_COL_PT, bottom)) for top, bottom in bands]
+        del page  # freeing a Page calls into MuPDF too
+    return [
+        (top, bottom, label_txt)
+        for (top, bottom), label_txt in zip(bands, ocr_strips(strips))
+        if label_txt in targets
+    ]
+
+
+def locate_page(
+    src, pdf_key: str, pno: int, targets: set[str], norm_targets: frozenset, mode: str = "auto"
+) -> List[Tuple[float, float, str]]:
+    """Return (top, bottom, label) in PDF points for every target system on page `pno`.
+
+    mode "text" only reads the text layer, "ocr" always goes through vision + OCR,
+    and "auto" uses the text layer where it has label-column lines, falling back
+    to OCR when it has none, or when they match no target on a page with images
+    (a scan with a stray footer or a poor OCR layer).
+    """
+    if mode != "ocr":
+        page_text, lines, page_h, has_images = page_text_layer(pdf_key, pno, src)
+        if mode == "text":
+            return locate_text(page_text, lines, page_h, norm_targets)
+        if lines:
+            matches = locate_text(page_text, lines, page_h, norm_targets)
+            if matches or not has_images:
+                return matches
+    return locate_ocr(src, pdf_key, pno, targets)
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def locate_all(pdf_key: str, targets: Tuple[str, ...], mode: str, _src) -> List[List[Tuple[float, float, str]]]:
+    """locate_page() for every page of `_src`, in page order.
+
+    Cached on (pdf_key, targets, mode), so changing only the padding skips the search.
+    """
+    target_set = set(targets)
+    norm_targets = frozenset(norm_label(t) for t in targets)
+
+    def locate(pno):
+        matches = locate_page(_src, pdf_key, pno, target_set, norm_targets, mode)
+        with _MUPDF_LOCK:
+            # MuPDF's resource store is unbounded by default; halve it after every
+            # page so long scores don't accumulate every decoded font and image
+            fitz.TOOLS.store_shrink(50)
+        return matches
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        return list(ex.map(locate, range(_src.page_count)))
+
+
+@st.cache_resource
+def released_pdfs() -> List[fitz.Document]:
+    """Documents evicted from open_pdf() that still have to be closed under the lock."""
+    return []
+
+
+def close_released_pdfs() -> None:
+    """Close the evicted Documents no extraction holds any more; call with _MUPDF_LOCK held.
+
+    Closing is what frees the MuPDF document, so the last Python reference,
+    wherever it is dropped, no longer calls into MuPDF.
+    """
+    pending, in_use = released_pdfs(), []
+    while pending:
+        doc = pending.pop()
+        # without other holders, only `doc` and getrefcount's argument refer to it
+        if sys.getrefcount(doc) > 2:
+            in_use.append(doc)
+        else:
+            doc.close()
+    pending.extend(in_use)
+
+
+def release_pdf(doc: fitz.Document) -> None:
+    with _MUPDF_LOCK:
+        released_pdfs().append(doc)
+        close_released_pdfs()
+
+
+@st.cache_resource(max_entries=4, on_release=release_pdf)
+def open_pdf(pdf_key: str, _pdf_bytes: bytes) -> fitz.Document:
+    """The parsed source document, kept across reruns while the same PDF is in use."""
+    with _MUPDF_LOCK:
+        return fitz.open(stream=_pdf_bytes, filetype="pdf")
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def extract_staffs(
+    pdf_bytes: bytes, targets: Tuple[str, ...], pad: int, mode: str = "auto", raster: bool = False
+) -> Tuple[bytes, List[str]]:
+    pdf_key = hashlib.sha1(pdf_bytes).hexdigest()
+    src = open_pdf(pdf_key, pdf_bytes)
+
+    per_page = locate_all(pdf_key, targets, mode, src)
+
+    # plan the output first: (output page, source page, clip, dest rect) per match
+    found_labels, plan = [], []
+    n_out, y_cursor = 0, 20
+    gap = 10
+    pad_pt = pad * 0.5  # slider is in zoom=2 pixels
+
+    with _MUPDF_LOCK:
+        page_sizes = [(r.width, r.height) for r in (page.rect for page in src)]
+    for pno, matches in enumerate(per_page):
+        page_w, page_h = page_sizes[pno]
+        bands = []
+        for top, bottom, label_txt in matches:
+            found_labels.append(label_txt)
+            top = max(0, top - pad_pt)
+            bottom = min(page_h, bottom + pad_pt)
+            # padded neighbours overlap; join them into one crop while it still fits a page
+            if bands and top <= bands[-1][1] and bottom - bands[-1][0] <= A4_H - 40:
+                bands[-1][1] = max(bands[-1][1], bottom)
             else:
-                continue
+                bands.append([top, bottom])
 
-            top = max(0, (y - pad) * scale)
-            bottom = min(page.rect.height, (y + h + pad) * scale)
-            clip = fitz.Rect(0, top, page.rect.width, bottom)
-            seg_h = clip.height
+        for top, bottom in bands:
+            clip = fitz.Rect(0, top, page_w, bottom)
+            seg_h = bottom - top
 
-            if dst_page is None or y_cursor + seg_h > a4h - 20:
-                dst_page = dst.new_page(width=a4w, height=a4h)
+            if not n_out or y_cursor + seg_h > A4_H - 20:
+                n_out += 1
                 y_cursor = 20
 
-            dest_rect = fitz.Rect(0, y_cursor, a4w, y_cursor + seg_h)
-            dst_page.show_pdf_page(dest_rect, src, pno, clip=clip)
+            plan.append((n_out - 1, pno, clip, fitz.Rect(0, y_cursor, A4_W, y_cursor + seg_h)))
             y_cursor += seg_h + gap
 
-    buf = io.BytesIO()
-    if dst.page_count:
-        dst.save(buf, deflate=True)
-    dst.close()
-    src.close()
-    return buf.getvalue(), found_labels
+    # then write it in one pass; the plan is in score order, so consecutive
+    # crops come from the same source page
+    with _MUPDF_LOCK:
+        dst = fitz.open()
+        out_page, dlist, dlist_pno = None, None, -1
+        for out_no, pno, clip, dest_rect in plan:
+            if out_page is None or out_page.number != out_no:
+                # adding a page invalidates Page objects of the document; finish each one first
+                out_page = dst.new_page(width=A4_W, height=A4_H)
+            if raster:
+                if dlist_pno != pno:
+                    # interpret the page's content once; every crop replays the display list
+                    dlist, dlist_pno = src.load_page(pno).get_displaylist(), pno
+                # scores are black on white: a gray pixmap has a third of the samples of RGB
+                pix = dlist.get_pixmap(
+                    matrix=fitz.Matrix(RASTER_ZOOM, RASTER_ZOOM), clip=clip, colorspace=fitz.csGRAY, alpha=False
+                )
+                out_page.insert_image(dest_rect, pixmap=pix)
+            else:
+                out_page.show_pdf_page(dest_rect, src, pno, clip=clip)
+
+        out = b""
+        if dst.page_count:
+            # garbage=4 also merges the duplicate objects show_pdf_page copies per crop
+            out = dst.tobytes(garbage=4, clean=True, deflate=True, deflate_images=True, deflate_fonts=True)
+        # drop the last page, display list and pixmap while MuPDF is still ours
+        out_page = dlist = pix = None
+        dst.close()
+        # `src` is still held here, so an evicted source is closed by a later run
+        close_released_pdfs()
+        fitz.TOOLS.store_shrink(100)
+    return out, found_labels
 
 
 # -------------------- Run on click -------------------- #
@@ -123,7 +438,7 @@ if run_btn:
         st.stop()
 
     with st.spinner("Running computer vision + OCR …"):
-        pdf_bytes, hits = extract_staffs(pdf_file.read(), labels_set, extra_pad)
+        pdf_bytes, hits = extract_staffs(pdf_file.getvalue(), tuple(sorted(labels_set)), extra_pad, mode, raster)
 
     if not pdf_bytes:
         st.warning("No matching systems were found.")